@@ -1,8 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import re
+from google.oauth2.service_account import Credentials
+
+from notas_utils import clean_nota_series
 
 # Constantes
 SCOPE = ["https://spreadsheets.google.com/feeds",
@@ -13,31 +15,15 @@ WORKSHEET_NOTAS = "Notas_Tabela"
 # Funções auxiliares
 
 
-def clean_nota_value(value):
-    """Converte valores de nota, tratando vírgulas, datas e outros formatos."""
-    if pd.isna(value):
-        return 0.0
-    value = str(value).strip()
-    value = value.replace(',', '.')
-    if re.match(r'^\d{1,2}/\d{1,2}$', value):
-        try:
-            parts = value.split('/')
-            value = f"{parts[0]}.{parts[1]}"
-        except:
-            return 0.0
-    value = re.sub(r'[^\d.]', '', value)
-    parts = value.split('.')
-    if len(parts) > 2:
-        value = parts[0] + '.' + ''.join(parts[1:])
-    return float(value) if value else 0.0
-
-
 @st.cache_data(show_spinner=False, ttl=300)
 def load_data(_client, sheet_name, worksheet_name):
     """Carrega dados da planilha."""
     try:
         sheet = _client.open(sheet_name).worksheet(worksheet_name)
-        df = pd.DataFrame(sheet.get_all_records())
+        # get_all_values evita os dicts por linha que get_all_records cria
+        values = sheet.get_all_values()
+        df = pd.DataFrame(values[1:], columns=values[0]) if len(
+            values) > 1 else pd.DataFrame()
         if df.empty:
             st.error("Planilha vazia.")
             st.stop()
@@ -49,47 +35,46 @@ def load_data(_client, sheet_name, worksheet_name):
         # Normalizar colunas de texto
         for col in required_cols[:-1]:  # Exceto 'Nota'
             df[col] = df[col].astype(str).str.strip().str.upper()
-        df['Nota'] = df['Nota'].apply(clean_nota_value)
+        # Colunas de baixa cardinalidade viram category: comparação por código
+        for col in ['Série', 'Bimestre', 'Tipo de Avaliação', 'Componente Curricular']:
+            df[col] = df[col].astype('category')
+        df['Nota'] = clean_nota_series(df['Nota'])
         return df
     except Exception as e:
         st.error(f"Erro ao acessar planilha: {e}")
         st.stop()
 
 
-def validate_matricula(nome, matricula, alunos_serie):
+@st.cache_data(show_spinner=False, ttl=300)
+def get_series(_df, df_key):
+    """Opções de série ordenadas, cacheadas por versão do DataFrame."""
+    return sorted(_df['Série'].dropna().unique().tolist())
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_alunos_serie(_df, serie, df_key):
+    """Alunos (nome, matrícula) de uma série, já ordenados por nome."""
+    return _df[_df['Série'] == serie][[
+        'Nome do Aluno', 'Matrícula']].drop_duplicates().sort_values('Nome do Aluno')
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_bimestres_por_aluno(_df, df_key):
+    """Mapa nome do aluno -> bimestres disponíveis, em um único groupby."""
+    grupos = _df.groupby('Nome do Aluno')['Bimestre'].unique()
+    return {nome: sorted(bims.tolist()) for nome, bims in grupos.items()}
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_pares_validos(_alunos_serie, serie, df_key):
+    """Conjunto (nome, matrícula) da série, montado em uma passada."""
+    return set(zip(_alunos_serie['Nome do Aluno'].str.upper(),
+                   _alunos_serie['Matrícula'].astype(str).str.strip()))
+
+
+def validate_matricula(nome, matricula, pares_validos):
     """Valida a matrícula do aluno."""
-    return not alunos_serie[
-        (alunos_serie['Nome do Aluno'].str.upper() == nome.upper()) &
-        (alunos_serie['Matrícula'].astype(
-            str).str.strip() == matricula.strip())
-    ].empty
-
-
-def calculate_media(resultado):
-    """Calcula a média entre MENSAL e BIMESTRAL para cada componente curricular."""
-    medias = {}
-    mensal_rows = resultado[resultado['Tipo de Avaliação'] == 'MENSAL']
-    bimestral_rows = resultado[resultado['Tipo de Avaliação'] == 'BIMESTRAL']
-
-    for comp in resultado['Componente Curricular'].unique():
-        mensal = mensal_rows[mensal_rows['Componente Curricular'] ==
-                             comp]['Nota'].iloc[0] if not mensal_rows[mensal_rows['Componente Curricular'] == comp].empty else 0.0
-        bimestral = bimestral_rows[bimestral_rows['Componente Curricular'] ==
-                                   comp]['Nota'].iloc[0] if not bimestral_rows[bimestral_rows['Componente Curricular'] == comp].empty else 0.0
-        if mensal > 0.0 or bimestral > 0.0:
-            medias[comp] = (mensal + bimestral) / 2
-        else:
-            medias[comp] = 0.0
-    return medias
-
-
-def check_recuperacao(medias):
-    """Verifica se recuperação é necessária para médias < 7."""
-    recuperacao_needed = []
-    for comp, media in medias.items():
-        if media < 7:
-            recuperacao_needed.append(f"{comp} (Média: {media:.2f})")
-    return recuperacao_needed
+    return (nome.upper(), matricula.strip()) in pares_validos
 
 
 def display_boletim(resultado):
@@ -101,16 +86,30 @@ def display_boletim(resultado):
     available_types = resultado['Tipo de Avaliação'].unique()
     ordered_types = [t for t in desired_order if t in available_types]
 
-    boletim = (
-        resultado.pivot_table(
-            index='Componente Curricular',
-            columns='Tipo de Avaliação',
-            values='Nota',
-            aggfunc='first'
-        )
-        .reindex(columns=ordered_types)
-        .reset_index()
+    # Projeção: filtra linhas e colunas antes do pivot, em vez de
+    # materializar tipos que seriam descartados no reindex
+    resultado = resultado.loc[
+        resultado['Tipo de Avaliação'].isin(desired_order),
+        ['Componente Curricular', 'Tipo de Avaliação', 'Nota']
+    ]
+
+    # Um único pivot alimenta o boletim, as médias e a checagem de recuperação
+    piv = resultado.pivot_table(
+        index='Componente Curricular',
+        columns='Tipo de Avaliação',
+        values='Nota',
+        aggfunc='first',
+        observed=True  # só os componentes/tipos presentes no resultado
     )
+    mensal = piv['MENSAL'].fillna(
+        0.0).to_numpy() if 'MENSAL' in piv.columns else np.zeros(len(piv))
+    bimestral = piv['BIMESTRAL'].fillna(
+        0.0).to_numpy() if 'BIMESTRAL' in piv.columns else np.zeros(len(piv))
+    medias = np.where((mensal > 0.0) | (bimestral > 0.0),
+                      (mensal + bimestral) / 2, 0.0)
+    recup_mask = medias < 7
+
+    boletim = piv.reindex(columns=ordered_types).reset_index()
     boletim.columns.name = None
     boletim = boletim.rename(columns={
         "MENSAL": "Men",
@@ -120,38 +119,31 @@ def display_boletim(resultado):
         "RECUPERAÇÃO FINAL": "Rec Final"
     })
 
-    # Calcular médias
-    medias = calculate_media(resultado)
     # Adicionar coluna de média calculada
-    boletim['Med'] = [medias.get(comp, 0.0)
-                      for comp in boletim['Componente Curricular']]
-
-    def colorir_nota(val):
-             if isinstance(val, (int, float)):
-                      if val < 7:
-                               return 'background-color: #ffd6d6; color: black; font-weight: bold; text-align: center'  # tom de vermelho claro
-                      else:
-                               return 'background-color: #d6ecff; color: black; font-weight: bold; text-align: center'  # tom de azul claro
-             return ''
+    boletim['Med'] = medias
 
+    def colorir_notas(col):
+        """Devolve o CSS da coluna inteira em uma comparação vetorizada."""
+        return np.where(
+            col < 7,
+            # tom de vermelho claro
+            'background-color: #ffd6d6; color: black; font-weight: bold; text-align: center',
+            # tom de azul claro
+            'background-color: #d6ecff; color: black; font-weight: bold; text-align: center')
 
     st.success("Notas encontradas:")
     st.dataframe(
         boletim.style
-        .applymap(colorir_nota, subset=boletim.columns[1:])
+        .apply(colorir_notas, subset=boletim.columns[1:])
         .format("{:.2f}", subset=boletim.columns[1:], na_rep="-")
     )
 
-    # Verificar e exibir mensagem de recuperação por disciplina
-    recuperacao_needed = check_recuperacao(medias)
-    if recuperacao_needed:
+    # Verificar e exibir mensagens de recuperação a partir da mesma máscara
+    componentes_recuperacao = piv.index[recup_mask]
+    if len(componentes_recuperacao) > 0:
         st.warning("Recuperação necessária para: " +
-                   ", ".join(recuperacao_needed))
-
-    # Verificar e exibir lista de disciplinas com média < 7
-    componentes_recuperacao = [comp for comp,
-                               media in medias.items() if media < 7]
-    if componentes_recuperacao:
+                   ", ".join(f"{comp} (Média: {media:.2f})" for comp, media
+                             in zip(componentes_recuperacao, medias[recup_mask])))
         st.warning("O ALUNO DEVERÁ FAZER PROVA DE RECUPERAÇÃO NA(S) SEGUINTE(S) DISCIPLINA(S): " +
                    ", ".join(componentes_recuperacao))
 
@@ -159,7 +151,7 @@ def display_boletim(resultado):
 # Autenticação via st.secrets
 try:
     creds_dict = dict(st.secrets["google_credentials"])
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
     client = gspread.authorize(creds)
 except Exception as e:
     st.error(f"Erro ao autenticar com Google Sheets: {e}")
@@ -176,8 +168,11 @@ if "consultado" in st.session_state and st.button("Nova consulta"):
     st.session_state.clear()
     st.rerun()
 
+# Chave barata para invalidar os caches de opções quando o DataFrame muda
+df_key = len(df)
+
 # 1️⃣ Selecionar Série
-series = sorted(df["Série"].dropna().unique().tolist())
+series = get_series(df, df_key)
 serie_selecionada = st.selectbox(
     "Selecione a série:", [""] + series, key="serie")
 
@@ -186,16 +181,15 @@ nome_selecionado = ""
 matricula_input = ""
 bimestres = []
 if serie_selecionada:
-    alunos_serie = df[df["Série"] == serie_selecionada][[
-        "Nome do Aluno", "Matrícula"]].drop_duplicates()
-    nomes = sorted(alunos_serie["Nome do Aluno"].tolist())
+    alunos_serie = get_alunos_serie(df, serie_selecionada, df_key)
+    nomes = alunos_serie["Nome do Aluno"].tolist()
     nome_selecionado = st.selectbox(
         "Selecione o aluno:", [""] + nomes, key="nome")
 
     # 3️⃣ Selecionar Bimestre
     if nome_selecionado:
-        bimestres = sorted(df[df["Nome do Aluno"] == nome_selecionado]
-                           ["Bimestre"].dropna().unique().tolist())
+        bimestres = get_bimestres_por_aluno(
+            df, df_key).get(nome_selecionado, [])
         bimestre = st.selectbox(
             "Selecione o bimestre/período:", [""] + bimestres + ["Final"], key="bimestre")
 
@@ -205,7 +199,9 @@ if serie_selecionada:
 
         # 5️⃣ Botão para consultar
         if st.button("Consultar"):
-            if validate_matricula(nome_selecionado, matricula_input, alunos_serie):
+            pares_validos = get_pares_validos(
+                alunos_serie, serie_selecionada, df_key)
+            if validate_matricula(nome_selecionado, matricula_input, pares_validos):
                 resultado = df[
                     (df['Nome do Aluno'].str.upper() == nome_selecionado.upper()) &
                     (df['Matrícula'].astype(str).str.strip() == matricula_input.strip()) &
@@ -1,10 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import os
-import re
+
+from notas_utils import clean_nota_series
 
 # Constantes
 SCOPE = ["https://spreadsheets.google.com/feeds",
@@ -23,65 +26,50 @@ def authenticate_gsheets(cred_file):
         st.error("Arquivo de credenciais não encontrado.")
         st.stop()
     try:
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            cred_file, SCOPE)
+        credentials = Credentials.from_service_account_file(
+            cred_file, scopes=SCOPE)
         return gspread.authorize(credentials)
     except Exception as e:
         st.error(f"Erro ao autenticar com Google Sheets: {e}")
         st.stop()
 
 
-def clean_nota_value(value):
-    """Converte valores de nota, tratando vírgulas, datas e outros formatos."""
-    if pd.isna(value):
-        return '0.0'
-    value = str(value).strip()
-    value = value.replace(',', '.')
-    if re.match(r'^\d{1,2}/\d{1,2}$', value):
-        try:
-            parts = value.split('/')
-            value = f"{parts[0]}.{parts[1]}"
-        except:
-            return '0.0'
-    value = re.sub(r'[^\d.]', '', value)
-    parts = value.split('.')
-    if len(parts) > 2:
-        value = parts[0] + '.' + ''.join(parts[1:])
-    return value if value else '0.0'
-
-
 @st.cache_data(show_spinner=False, ttl=300)
 def load_data(_client, worksheet_name, _cache_version=0):
     """Carrega dados de uma planilha como DataFrame."""
-    try:
-        sheet = _client.open(SHEET_NAME).worksheet(worksheet_name)
-        data = pd.DataFrame(sheet.get_all_records())
-        headers = sheet.row_values(1)
-        # Normalizar colunas de texto
-        for col in ['Matrícula', 'Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
-            if col in data.columns:
-                data[col] = data[col].astype(str).str.strip().str.upper()
-        # Converte a coluna 'Nota'
-        if 'Nota' in data.columns:
-            data['Nota'] = data['Nota'].apply(clean_nota_value)
-            data['Nota'] = pd.to_numeric(
-                data['Nota'], errors='coerce').fillna(0.0)
-        # Adiciona índice da linha (1-based, considerando cabeçalho)
-        data['row_index'] = data.index + 2
-        return data, sheet, headers
-    except gspread.exceptions.WorksheetNotFound:
-        st.error(f"Planilha {worksheet_name} não encontrada.")
-        return pd.DataFrame(), None, []
-    except Exception as e:
-        st.error(f"Erro ao carregar planilha {worksheet_name}: {e}")
-        st.stop()
+    # Roda em threads sem ScriptRunContext: nada de st.* aqui; falhas
+    # propagam e são reportadas na thread principal após o .result()
+    sheet = _client.open(SHEET_NAME).worksheet(worksheet_name)
+    # get_all_values evita os dicts por linha de get_all_records e já
+    # traz o cabeçalho, dispensando o row_values(1) extra
+    values = sheet.get_all_values()
+    headers = values[0] if values else []
+    data = pd.DataFrame(values[1:], columns=headers) if len(
+        values) > 1 else pd.DataFrame(columns=headers)
+    # Normalizar colunas de texto
+    for col in ['Matrícula', 'Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
+        if col in data.columns:
+            data[col] = data[col].astype(str).str.strip().str.upper()
+    # Colunas de baixa cardinalidade viram category: comparação por código
+    for col in ['Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
+        if col in data.columns:
+            data[col] = data[col].astype('category')
+    # Converte a coluna 'Nota'
+    if 'Nota' in data.columns:
+        data['Nota'] = clean_nota_series(data['Nota'])
+    # Adiciona índice da linha (1-based, considerando cabeçalho)
+    data['row_index'] = data.index + 2
+    # Resolve a letra da coluna 'Nota' uma única vez, junto com o schema
+    nota_idx = headers.index("Nota") + 1 if "Nota" in headers else 8
+    nota_col = gspread.utils.rowcol_to_a1(1, nota_idx)[:-1]
+    return data, sheet, headers, nota_col
 
 
 def validate_period(bimestre, df_periodo, today):
     """Valida se o período de lançamento está liberado."""
     bimestre = str(bimestre).strip().upper()
-    periodo_ok = df_periodo[df_periodo['Bimestre'].str.strip(
-    ).str.upper() == bimestre]
+    # 'Bimestre' já foi normalizado em load_data
+    periodo_ok = df_periodo[df_periodo['Bimestre'] == bimestre]
     if periodo_ok.empty:
         return False, "Lançamento não autorizado para este período. Consulte o gestor."
     try:
@@ -98,13 +86,47 @@ def validate_period(bimestre, df_periodo, today):
 
 def validate_professor(mat_prof, df):
     """Verifica se a matrícula do professor é válida."""
-    return str(mat_prof).strip().upper() in df['Mat_Professor'].str.strip().str.upper().values
+    return str(mat_prof).strip().upper() in df['Mat_Professor'].values
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_prof_series(_df, df_key):
+    """Mapa Mat_Professor -> séries, calculado em um único groupby."""
+    grupos = _df.groupby('Mat_Professor', observed=True)['Série'].unique()
+    return {prof: sorted(s.tolist()) for prof, s in grupos.items()}
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_prof_componentes(_df, df_key):
+    """Mapa (Mat_Professor, Série) -> componentes curriculares."""
+    grupos = _df.groupby(['Mat_Professor', 'Série'], observed=True)[
+        'Componente Curricular'].unique()
+    return {chave: sorted(c.tolist()) for chave, c in grupos.items()}
+
+
+def coalesce_batch_updates(rows, valores, col_letter):
+    """Agrupa linhas contíguas em um único range A1 com bloco 2D de valores."""
+    rows = np.asarray(rows, dtype=int)
+    valores = np.asarray(valores)
+    ordem = np.argsort(rows)
+    rows = rows[ordem]
+    valores = valores[ordem]
+    payload = []
+    inicio = 0
+    for i in range(1, len(rows) + 1):
+        if i == len(rows) or rows[i] != rows[i - 1] + 1:
+            payload.append({
+                "range": f"{col_letter}{rows[inicio]}:{col_letter}{rows[i - 1]}",
+                "values": [[v] for v in valores[inicio:i]],
+            })
+            inicio = i
+    return payload
 
 
 def logout():
     """Limpa a autenticação do professor e parâmetros."""
     for key in list(st.session_state.keys()):
-        if key not in ["df", "sheet_notas", "df_periodo", "headers_notas", "cache_version"]:
+        if key not in ["df", "sheet_notas", "df_periodo", "headers_notas", "nota_col", "cache_version"]:
             del st.session_state[key]
     st.success("Deslogado com sucesso!")
     st.rerun()
@@ -115,19 +137,36 @@ client = authenticate_gsheets(CRED_FILE)
 if "cache_version" not in st.session_state:
     st.session_state["cache_version"] = 0
 if "df" not in st.session_state:
-    st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"] = load_data(
-        client, WORKSHEET_NOTAS, _cache_version=st.session_state["cache_version"])
-    st.session_state["df_periodo"], _, _ = load_data(
-        client, WORKSHEET_CONTROLE, _cache_version=st.session_state["cache_version"])
+    # Cada load é um round-trip bloqueante; busca as duas planilhas em paralelo
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_notas = ex.submit(
+            load_data, client, WORKSHEET_NOTAS,
+            _cache_version=st.session_state["cache_version"])
+        fut_periodo = ex.submit(
+            load_data, client, WORKSHEET_CONTROLE,
+            _cache_version=st.session_state["cache_version"])
+        # Reporta falhas aqui, na thread principal, onde st.* funciona
+        try:
+            st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"], st.session_state["nota_col"] = fut_notas.result()
+        except gspread.exceptions.WorksheetNotFound:
+            st.error(f"Planilha {WORKSHEET_NOTAS} não encontrada.")
+            st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"], st.session_state["nota_col"] = pd.DataFrame(), None, [], ""
+        except Exception as e:
+            st.error(f"Erro ao carregar planilha {WORKSHEET_NOTAS}: {e}")
+            st.stop()
+        try:
+            st.session_state["df_periodo"], _, _, _ = fut_periodo.result()
+        except gspread.exceptions.WorksheetNotFound:
+            st.error(f"Planilha {WORKSHEET_CONTROLE} não encontrada.")
+            st.session_state["df_periodo"] = pd.DataFrame()
+        except Exception as e:
+            st.error(f"Erro ao carregar planilha {WORKSHEET_CONTROLE}: {e}")
+            st.stop()
 df = st.session_state["df"]
 sheet_notas = st.session_state["sheet_notas"]
 df_periodo = st.session_state["df_periodo"]
 headers_notas = st.session_state["headers_notas"]
-
-# Encontra a coluna 'Nota'
-nota_column_idx = headers_notas.index(
-    "Nota") + 1 if "Nota" in headers_notas else 8  # Default para H (índice 8)
-nota_column_letter = chr(64 + nota_column_idx)
+nota_column_letter = st.session_state["nota_col"]
 
 # Interface
 st.title("📘 Lançamento de Notas por Professor")
@@ -161,16 +200,19 @@ else:
     mat_prof = st.session_state["mat_prof"]
 
     st.subheader("2. Parâmetros do Lançamento")
-    series_disponiveis = df[df['Mat_Professor'].str.strip().str.upper(
-    ) == mat_prof.strip().upper()]['Série'].unique().tolist()
+    # Normaliza as entradas uma única vez; as colunas já saem normalizadas de load_data
+    mat_prof_n = str(mat_prof).strip().upper()
+    # Mapas pré-computados substituem o scan booleano por rerun
+    df_key = (len(df), st.session_state["cache_version"])
+    series_disponiveis = get_prof_series(df, df_key).get(mat_prof_n, [])
     if not series_disponiveis:
         st.error("Nenhuma série associada a esta matrícula.")
         st.stop()
 
     serie = st.selectbox(
         "Série", options=[""] + series_disponiveis, index=0, key="serie")
-    componentes = df[(df['Mat_Professor'].str.strip().str.upper() == mat_prof.strip().upper()) &
-                     (df['Série'].str.strip().str.upper() == str(serie).strip().upper())]['Componente Curricular'].unique() if serie else []
+    componentes = get_prof_componentes(df, df_key).get(
+        (mat_prof_n, serie), []) if serie else []
     componente = st.selectbox(
         "Componente Curricular",
         options=[""] + list(componentes) if len(componentes) > 0 else [""],
@@ -203,7 +245,7 @@ else:
         st.stop()
 
     # Carrega alunos
-    alunos_serie = df[(df['Série'].str.strip().str.upper() == str(serie).strip().upper())][[
+    alunos_serie = df[df['Série'] == serie][[
         'Nome do Aluno', 'Matrícula', 'Turno']].drop_duplicates(subset=['Matrícula']).sort_values(by='Nome do Aluno')
 
     if alunos_serie.empty:
@@ -212,37 +254,40 @@ else:
 
     # 3. Lançamento de Notas
     st.subheader("3. Lançamento de Notas")
+
+    # Uma única busca indexada substitui o scan booleano por aluno:
+    # notas e linhas existentes saem de um reindex sobre o MultiIndex
+    key_cols = ['Matrícula', 'Série', 'Componente Curricular',
+                'Bimestre', 'Tipo de Avaliação']
+    lookup = df.drop_duplicates(subset=key_cols).set_index(key_cols)
+    n_alunos = len(alunos_serie)
+    # serie/componente/tipo já vêm normalizados dos mapas e das opções em
+    # maiúsculas; o selectbox de bimestre oferece "Final", então normaliza
+    bimestre_n = str(bimestre).strip().upper()
+    keys = pd.MultiIndex.from_arrays([
+        alunos_serie['Matrícula'],
+        [serie] * n_alunos,
+        [componente] * n_alunos,
+        [bimestre_n] * n_alunos,
+        [tipo_avaliacao] * n_alunos,
+    ], names=key_cols)
+    notas_existentes = lookup['Nota'].reindex(keys).fillna(0.0).to_numpy()
+    rows_existentes = lookup['row_index'].reindex(keys).to_numpy(dtype=float)
+
     with st.form("form_lote_notas"):
-        notas = {}
-        for idx, row in alunos_serie.iterrows():
-            nome = row['Nome do Aluno']
-            matricula = row['Matrícula']
-            col_id = f"nota_{matricula}_{serie}_{componente}_{bimestre}_{tipo_avaliacao}_{idx}"
-
-            # Normalizar valores para o filtro
-            matricula_norm = str(matricula).strip().upper()
-            serie_norm = str(serie).strip().upper()
-            componente_norm = str(componente).strip().upper()
-            bimestre_norm = str(bimestre).strip().upper()
-            tipo_avaliacao_norm = str(tipo_avaliacao).strip().upper()
-
-            # Busca nota existente
-            cond = (
-                (df['Matrícula'].str.strip().str.upper() == matricula_norm) &
-                (df['Série'].str.strip().str.upper() == serie_norm) &
-                (df['Componente Curricular'].str.strip().str.upper() == componente_norm) &
-                (df['Bimestre'].str.strip().str.upper() == bimestre_norm) &
-                (df['Tipo de Avaliação'].str.strip(
-                ).str.upper() == tipo_avaliacao_norm)
-            )
-            if not df[cond].empty:
-                nota_existente = float(df[cond]['Nota'].values[0])
-            else:
-                nota_existente = 0.0
+        # Array contíguo alinhado a alunos_serie, pronto para as máscaras
+        # vetorizadas da fase de salvamento
+        notas_arr = np.zeros(n_alunos)
+        # itertuples emite tuplas simples, sem criar uma Series por aluno
+        for i, (nome, matricula, turno) in enumerate(
+                alunos_serie.itertuples(index=False, name=None)):
+            col_id = f"nota_{matricula}_{serie}_{componente}_{bimestre}_{tipo_avaliacao}_{i}"
+
+            nota_existente = float(notas_existentes[i])
 
             cols = st.columns([3, 1])
             cols[0].markdown(f"**{nome} ({matricula})**")
-            notas[matricula] = cols[1].number_input(
+            notas_arr[i] = cols[1].number_input(
                 "", min_value=0.0, max_value=10.0, step=0.1, value=nota_existente, key=col_id)
 
         sobrescrever = st.checkbox(
@@ -251,79 +296,106 @@ else:
 
         if submitted:
             with st.spinner("Salvando notas..."):
-                registros = []
                 erros = []
                 atualizados = []
                 batch_updates = []
 
-                for _, row in alunos_serie.iterrows():
-                    nome = row['Nome do Aluno']
-                    matricula = row['Matrícula']
-                    turno = row['Turno']
-                    nota_valor = notas[matricula]
-
-                    if nota_valor == 0.0:
-                        continue
-
-                    nova_linha = [
-                        nome, matricula, serie, turno, componente,
-                        bimestre, tipo_avaliacao, f"{nota_valor:.2f}", nome_prof, mat_prof
-                    ]
-
-                    cond = (
-                        (df['Matrícula'].str.strip().str.upper() == str(matricula).strip().upper()) &
-                        (df['Série'].str.strip().str.upper() == str(serie).strip().upper()) &
-                        (df['Componente Curricular'].str.strip().str.upper() == str(componente).strip().upper()) &
-                        (df['Bimestre'].str.strip().str.upper() == str(bimestre).strip().upper()) &
-                        (df['Tipo de Avaliação'].str.strip().str.upper()
-                         == str(tipo_avaliacao).strip().upper())
-                    )
-
-                    existe = df[cond]
-                    if not existe.empty:
-                        if sobrescrever:
-                            try:
-                                row_idx = existe['row_index'].values[0]
-                                batch_updates.append({
-                                    "range": f"{nota_column_letter}{row_idx}",
-                                    "values": [[f"{nota_valor:.2f}"]]
-                                })
-                                atualizados.append(
-                                    f"🔁 Atualizado: {nome} ({matricula})")
-                            except Exception as e:
-                                erros.append(
-                                    f"⚠️ Erro ao preparar atualização para {nome} ({matricula}): {e}")
-                        else:
-                            erros.append(
-                                f"⚠️ Nota existente para {nome} ({matricula}). Ignorado.")
-                        continue
-
-                    registros.append(nova_linha)
+                # Lote vetorizado: junta as notas digitadas com as linhas já
+                # existentes (reaproveitando o reindex feito antes do
+                # formulário) e separa atualização de inserção por máscara
+                batch = alunos_serie[['Nome do Aluno',
+                                      'Matrícula', 'Turno']].copy()
+                batch['Nota_new'] = notas_arr
+                batch['row_index'] = rows_existentes
+                lancadas = notas_arr > 0.0
+                existe_mask = ~np.isnan(rows_existentes)
+
+                updates = batch[lancadas & existe_mask]
+                inserts = batch[lancadas & ~existe_mask]
+
+                if not updates.empty:
+                    if sobrescrever:
+                        # Linhas contíguas viram um único range por chamada
+                        batch_updates = coalesce_batch_updates(
+                            updates['row_index'].to_numpy(dtype=int),
+                            [f"{valor:.2f}" for valor in updates['Nota_new']],
+                            nota_column_letter)
+                        atualizados = [
+                            f"🔁 Atualizado: {nome} ({matricula})"
+                            for nome, matricula in zip(updates['Nome do Aluno'],
+                                                       updates['Matrícula'])
+                        ]
+                    else:
+                        erros = [
+                            f"⚠️ Nota existente para {nome} ({matricula}). Ignorado."
+                            for nome, matricula in zip(updates['Nome do Aluno'],
+                                                       updates['Matrícula'])
+                        ]
+
+                registros = [
+                    [nome, matricula, serie, turno, componente,
+                     bimestre, tipo_avaliacao, f"{valor:.2f}", nome_prof, mat_prof]
+                    for nome, matricula, turno, valor in zip(
+                        inserts['Nome do Aluno'], inserts['Matrícula'],
+                        inserts['Turno'], inserts['Nota_new'])
+                ]
 
                 # Executa atualizações em lote
+                updates_ok = False
                 if batch_updates:
                     try:
                         sheet_notas.batch_update(batch_updates)
+                        updates_ok = True
                         st.info("Atualizações em lote realizadas com sucesso!")
                     except Exception as e:
                         erros.append(
                             f"⚠️ Erro ao executar atualizações em lote: {e}")
 
                 # Adiciona novos registros
+                inserts_ok = False
                 if registros:
                     try:
                         sheet_notas.append_rows(registros)
+                        inserts_ok = True
                         st.success(f"✅ {len(registros)} notas lançadas!")
                     except Exception as e:
                         erros.append(f"Erro ao salvar notas: {e}")
 
-                if batch_updates or registros:
-                    # Invalida o cache
+                if updates_ok or inserts_ok:
+                    # Espelha em memória apenas o que a API confirmou, para o
+                    # df não divergir da planilha quando uma chamada falha
+                    df_atual = st.session_state["df"]
+                    if updates_ok:
+                        novas_notas = df_atual['row_index'].map(
+                            dict(zip(updates['row_index'].astype(int),
+                                     updates['Nota_new'])))
+                        df_atual['Nota'] = novas_notas.fillna(df_atual['Nota'])
+                    if inserts_ok:
+                        novas_linhas = pd.DataFrame(
+                            registros, columns=headers_notas)
+                        proxima = int(df_atual['row_index'].max()) + \
+                            1 if len(df_atual) else 2
+                        novas_linhas['row_index'] = range(
+                            proxima, proxima + len(novas_linhas))
+                        # Mesma normalização aplicada em load_data
+                        for col in ['Matrícula', 'Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
+                            if col in novas_linhas.columns:
+                                novas_linhas[col] = novas_linhas[col].astype(
+                                    str).str.strip().str.upper()
+                        novas_linhas['Nota'] = clean_nota_series(
+                            novas_linhas['Nota'])
+                        df_atual = pd.concat(
+                            [df_atual, novas_linhas], ignore_index=True)
+                        # Reaplica category (concat volta a object quando as
+                        # categorias diferem)
+                        for col in ['Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
+                            if col in df_atual.columns:
+                                df_atual[col] = df_atual[col].astype(
+                                    'category')
+                    st.session_state["df"] = df_atual
+                    # A próxima chamada real a load_data (nova sessão ou TTL
+                    # vencido) rebusca da planilha
                     st.session_state["cache_version"] += 1
-                    st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"] = load_data(
-                        client, WORKSHEET_NOTAS, _cache_version=st.session_state["cache_version"])
-                    st.session_state["df_periodo"], _, _ = load_data(
-                        client, WORKSHEET_CONTROLE, _cache_version=st.session_state["cache_version"])
 
                 if atualizados:
                     st.info("\n".join(atualizados))
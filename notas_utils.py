@@ -0,0 +1,115 @@
+"""Limpeza da coluna 'Nota', compartilhada entre consulta e lançamento."""
+import re
+
+import pandas as pd
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba é opcional; sem ele vale o caminho pandas
+    njit = None
+
+# Padrões pré-compilados usados na limpeza de notas
+_DATE_RE = re.compile(r'^\d{1,2}/\d{1,2}$')
+_NONNUM_RE = re.compile(r'[^\d.]')
+
+
+def clean_nota_value(value):
+    """Converte valores de nota, tratando vírgulas, datas e outros formatos."""
+    if pd.isna(value):
+        return 0.0
+    value = str(value).strip()
+    value = value.replace(',', '.')
+    if _DATE_RE.match(value):
+        try:
+            parts = value.split('/')
+            value = f"{parts[0]}.{parts[1]}"
+        except:
+            return 0.0
+    value = _NONNUM_RE.sub('', value)
+    parts = value.split('.')
+    if len(parts) > 2:
+        value = parts[0] + '.' + ''.join(parts[1:])
+    return float(value) if value else 0.0
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _parse_notas_kernel(buf, offsets):
+        """Parser byte a byte com a mesma semântica de clean_nota_value."""
+        n = offsets.shape[0] - 1
+        out = np.empty(n, dtype=np.float64)
+        for i in range(n):
+            inicio = offsets[i]
+            fim = offsets[i + 1]
+            # Equivalente ao .strip() do caminho escalar
+            while inicio < fim and (buf[inicio] == 32 or buf[inicio] == 9):
+                inicio += 1
+            while fim > inicio and (buf[fim - 1] == 32 or buf[fim - 1] == 9):
+                fim -= 1
+            # Detecta o formato de data dd/dd: só nesse caso a barra vira
+            # separador decimal; fora dele ela é descartada como qualquer
+            # caractere não numérico
+            d1 = 0
+            d2 = 0
+            barras = 0
+            so_data = fim > inicio
+            for j in range(inicio, fim):
+                b = buf[j]
+                if b == 47:  # '/'
+                    barras += 1
+                elif 48 <= b <= 57:
+                    if barras == 0:
+                        d1 += 1
+                    else:
+                        d2 += 1
+                else:
+                    so_data = False
+                    break
+            data_form = (so_data and barras == 1 and
+                         1 <= d1 <= 2 and 1 <= d2 <= 2)
+
+            inteiro = 0.0
+            fracao = 0.0
+            escala = 0.1
+            decimal = False
+            tem_digito = False
+            for j in range(inicio, fim):
+                b = buf[j]
+                if 48 <= b <= 57:  # dígito
+                    tem_digito = True
+                    if decimal:
+                        fracao += (b - 48) * escala
+                        escala *= 0.1
+                    else:
+                        inteiro = inteiro * 10.0 + (b - 48)
+                elif b == 44 or b == 46 or (b == 47 and data_form):
+                    decimal = True  # ',', '.' ou '/' em data dd/dd
+            out[i] = inteiro + fracao if tem_digito else 0.0
+        return out
+
+    def _parse_notas_numba(s):
+        """Empacota a coluna como bytes contíguos e chama o kernel JIT."""
+        encoded = [str(v).encode('ascii', 'ignore') for v in s.to_numpy()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        if encoded:
+            offsets[1:] = np.cumsum([len(e) for e in encoded])
+        buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return pd.Series(_parse_notas_kernel(buf, offsets), index=s.index)
+
+
+def clean_nota_series(s):
+    """Versão vetorizada de clean_nota_value para a coluna 'Nota' inteira."""
+    if njit is not None:
+        return _parse_notas_numba(s)
+    s = s.astype('string').str.strip().str.replace(',', '.', regex=False)
+    # Valores no formato dd/dd viram dd.dd
+    mask = s.str.match(r'^\d{1,2}/\d{1,2}$').fillna(False)
+    s = s.mask(mask, s.str.replace('/', '.', regex=False))
+    s = s.str.replace(r'[^\d.]', '', regex=True)
+    # Colapsa valores com mais de um ponto (ex.: "1.2.3" -> "1.23")
+    parts = s.str.split('.', n=1, expand=True)
+    if parts.shape[1] > 1:
+        resto = parts[1].str.replace('.', '', regex=False)
+        s = s.mask(resto.notna(), parts[0] + '.' + resto)
+    return pd.to_numeric(s, errors='coerce').fillna(0.0)